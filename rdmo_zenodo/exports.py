@@ -1,44 +1,90 @@
 import logging
+from functools import cached_property
+from http.cookiejar import DefaultCookiePolicy
 
 from django import forms
+from django.apps import apps
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Prefetch
 from django.shortcuts import redirect, render, reverse
 from django.utils.translation import gettext_lazy as _
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 from rdmo.projects.exports import Export
 from rdmo.services.providers import OauthProviderMixin
 
 logger = logging.getLogger(__name__)
 
 
+class ZenodoRetry(Retry):
+
+    # upper bound for the Retry-After header in seconds, so that retrying a
+    # rate limited request does not block the worker for longer than that
+    retry_after_cap = 10
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        else:
+            return min(retry_after, self.retry_after_cap)
+
+
 class BaseZenodoExportProvider(OauthProviderMixin, Export):
 
-    @property
+    session = None
+
+    # (connect, read) timeout in seconds, so that a stalled connection does not block the worker
+    timeout = (5, 30)
+
+    @classmethod
+    def get_session(cls):
+        # the session is shared by all exports of this worker process, so that the
+        # keep-alive connection (and TLS session) to Zenodo is reused between requests
+        if cls.session is None:
+            # creating a deposit is not idempotent, so apart from failed connections only
+            # rate limited requests (429), which Zenodo did not process, are retried
+            retries = ZenodoRetry(total=3, connect=3, read=False, status=2, backoff_factor=0.3,
+                                  status_forcelist=(429,), allowed_methods=None, raise_on_status=False)
+
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries))
+
+            # never keep cookies set by Zenodo, since the session is shared between users
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+            cls.session = session
+
+        return cls.session
+
+    @cached_property
     def client_id(self):
         return settings.ZENODO_PROVIDER['client_id']
 
-    @property
+    @cached_property
     def client_secret(self):
         return settings.ZENODO_PROVIDER['client_secret']
 
-    @property
+    @cached_property
     def zenodo_url(self):
         return settings.ZENODO_PROVIDER.get('zenodo_url', 'https://sandbox.zenodo.org').strip('/')
 
-    @property
+    @cached_property
     def authorize_url(self):
         return f'{self.zenodo_url}/oauth/authorize'
 
-    @property
+    @cached_property
     def token_url(self):
         return f'{self.zenodo_url}/oauth/token'
 
-    @property
+    @cached_property
     def deposit_url(self):
         return f'{self.zenodo_url}/api/records'
 
-    @property
+    @cached_property
     def redirect_path(self):
         return reverse('oauth_callback', args=['zenodo'])
 
@@ -60,6 +106,53 @@ class BaseZenodoExportProvider(OauthProviderMixin, Export):
             'code': request.GET.get('code')
         }
 
+    def post(self, request, url, json=None, files=None, multipart=None):
+        access_token = self.get_from_session(request, 'access_token')
+        if access_token and files is None and multipart is None:
+            logger.debug('post: %s %s', url, json)
+
+            try:
+                response = self.get_session().post(url, json=json, timeout=self.timeout,
+                                                   headers=self.get_authorization_headers(access_token))
+
+            except requests.ReadTimeout as e:
+                # the request was sent, so Zenodo may have created the draft nevertheless
+                logger.warning('post timeout: %s (%s)', url, e)
+
+                return render(request, 'core/error.html', {
+                    'title': _('ZENODO error'),
+                    'errors': [_('Zenodo did not respond in time. The draft may already exist on Zenodo, '
+                                 'please check your uploads there before exporting again.')]
+                }, status=200)
+
+            except requests.RequestException as e:
+                logger.warning('post error: %s (%s)', url, e)
+
+                return render(request, 'core/error.html', {
+                    'title': _('ZENODO error'),
+                    'errors': [_('Something went wrong: %s') % e]
+                }, status=200)
+
+            if response.status_code != 401:
+                try:
+                    response.raise_for_status()
+                    return self.post_success(request, response)
+
+                except requests.HTTPError:
+                    logger.warning('post error: %s (%s)', response.content, response.status_code)
+
+                    return render(request, 'core/error.html', {
+                        'title': _('ZENODO error'),
+                        'errors': [_('Something went wrong: %s') % self.get_error_message(response)]
+                    }, status=200)
+
+            logger.warning('post forbidden: %s (%s)', response.content, response.status_code)
+            self.pop_from_session(request, 'access_token')
+
+        # uploads and requests without a (valid) access token are handled by the mixin,
+        # which stores the request in the session and authorizes first
+        return super().post(request, url, json=json, files=files, multipart=multipart)
+
     def get_error_message(self, response):
         return response.json().get('errors')
 
@@ -76,17 +169,17 @@ class ZenodoExportProvider(BaseZenodoExportProvider):
 
     class Form(forms.Form):
 
-        dataset = forms.CharField(label=_('Select dataset of your project'))
+        dataset = forms.TypedChoiceField(label=_('Select dataset of your project'),
+                                         coerce=int, widget=forms.RadioSelect)
 
         def __init__(self, *args, **kwargs):
             dataset_choices = kwargs.pop('dataset_choices')
             super().__init__(*args, **kwargs)
 
-            self.fields['dataset'].widget = forms.RadioSelect(choices=dataset_choices)
+            self.fields['dataset'].choices = dataset_choices
 
     def render(self):
-        datasets = self.get_set('project/dataset/id')
-        dataset_choices = [(dataset.set_index, dataset.value)for dataset in datasets]
+        dataset_choices = self.get_dataset_choices()
 
         self.store_in_session(self.request, 'dataset_choices', dataset_choices)
 
@@ -97,7 +190,11 @@ class ZenodoExportProvider(BaseZenodoExportProvider):
         return render(self.request, 'plugins/exports_zenodo.html', {'form': form}, status=200)
 
     def submit(self):
+        # the choices are missing from the session if it expired or render was never called
         dataset_choices = self.get_from_session(self.request, 'dataset_choices')
+        if dataset_choices is None:
+            dataset_choices = self.get_dataset_choices()
+
         form = self.Form(self.request.POST, dataset_choices=dataset_choices)
 
         if 'cancel' in self.request.POST:
@@ -120,6 +217,10 @@ class ZenodoExportProvider(BaseZenodoExportProvider):
                 'errors': [_('The URL of the new dataset could not be retrieved.')]
             }, status=200)
 
+    def get_dataset_choices(self):
+        datasets = self.get_set('project/dataset/id')
+        return [(dataset.set_index, dataset.value) for dataset in datasets]
+
     def get_post_url(self):
         return self.deposit_url
 
@@ -127,72 +228,94 @@ class ZenodoExportProvider(BaseZenodoExportProvider):
         # see https://inveniordm.docs.cern.ch/reference/metadata/ for invenio metadata
         metadata = {}
 
+        zenodo_provider = settings.ZENODO_PROVIDER
+
         # set the resource_type from the settings
-        resource_type = settings.ZENODO_PROVIDER.get('resource_type')
+        resource_type = zenodo_provider.get('resource_type')
         if resource_type:
             metadata['resource_type'] = {
                 'id': resource_type
             }
 
         # add the creators from the project members
-        add_project_members = settings.ZENODO_PROVIDER.get('add_project_members')
+        add_project_members = zenodo_provider.get('add_project_members')
         if add_project_members:
+            users = self.project.user.all()
+
+            # fetch the orcid accounts of all users in one query, if allauth is used
+            if apps.is_installed('allauth.socialaccount'):
+                from allauth.socialaccount.models import SocialAccount
+
+                users = users.prefetch_related(Prefetch(
+                    'socialaccount_set',
+                    queryset=SocialAccount.objects.filter(provider='orcid'),
+                    to_attr='orcid_socialaccounts'
+                ))
+
             metadata['creators'] = []
-            for user in self.project.user.all():
+            for user in users:
                 creator = {
                     'family_name': user.last_name,
                     'given_name': user.first_name,
                     'type': 'personal'
                 }
 
-                try:
-                    orcid_socialaccount = user.socialaccount_set.get(provider='orcid')
+                orcid_socialaccounts = getattr(user, 'orcid_socialaccounts', None)
+                if orcid_socialaccounts:
                     creator['identifiers'] = [
                         {
                             'scheme': 'orcid',
-                            'identifier': orcid_socialaccount.uid
+                            'identifier': orcid_socialaccounts[0].uid
                         }
                     ]
-                except (ObjectDoesNotExist, AttributeError):
-                    pass
 
                 metadata['creators'].append({
                     'person_or_org': creator
                 })
 
+        # fetch the title, id and description of the dataset in one query
+        dataset_values = (
+            self.get_values('project/dataset/title', set_index=set_index) |
+            self.get_values('project/dataset/id', set_index=set_index) |
+            self.get_values('project/dataset/description', set_index=set_index)
+        )
+        dataset_texts = {}
+        for value in dataset_values.select_related('attribute').order_by('collection_index'):
+            dataset_texts.setdefault(value.attribute.path, value.text)
+
         # set the title from the title or id or the running index
         metadata['title'] =  \
-            self.get_text('project/dataset/title', set_index=set_index) or \
-            self.get_text('project/dataset/id', set_index=set_index) or \
+            dataset_texts.get('project/dataset/title') or \
+            dataset_texts.get('project/dataset/id') or \
             f'Dataset #{set_index + 1}'
 
         # set the description
-        description = self.get_text('project/dataset/description', set_index=set_index)
+        description = dataset_texts.get('project/dataset/description')
         if description:
             metadata['description'] = description
 
         # set the rights/licenses
-        for rights in self.get_values('project/dataset/sharing/conditions', set_index=set_index):
-            if rights.option:
-                metadata['rights'] = [{
-                    'id': self.rights_uri_options.get(rights.option.uri_path)
-                }]
-                break
+        rights_values = self.get_values('project/dataset/sharing/conditions', set_index=set_index)
+        rights = rights_values.exclude(option=None).select_related('option').first()
+        if rights:
+            metadata['rights'] = [{
+                'id': self.rights_uri_options.get(rights.option.uri_path)
+            }]
 
         # set the language from the settings
-        language = settings.ZENODO_PROVIDER.get('language')
+        language = zenodo_provider.get('language')
         if language:
             metadata['languages'] = [
                 {'id': language}
             ]
 
         # set the publisher from the settings
-        publisher = settings.ZENODO_PROVIDER.get('publisher')
+        publisher = zenodo_provider.get('publisher')
         if publisher:
             metadata['publisher'] = publisher
 
         # set the funding from the settings
-        funding = settings.ZENODO_PROVIDER.get('funding')
+        funding = zenodo_provider.get('funding')
         if funding:
             metadata['funding'] = funding
 
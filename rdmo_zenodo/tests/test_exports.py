@@ -0,0 +1,175 @@
+import io
+from unittest import mock
+
+import pytest
+
+import requests
+from urllib3 import HTTPResponse
+from urllib3.connectionpool import HTTPConnectionPool
+
+from rdmo.core.plugins import get_plugin
+from rdmo.services.views import oauth_callback
+
+url = 'https://zenodo.example.com/api/records'
+data = {'metadata': {'title': 'Dataset #1'}}
+zenodo_url = 'https://zenodo.example.com/uploads/1'
+
+
+def get_provider():
+    return get_plugin('PROJECT_EXPORTS', 'zenodo')
+
+
+def get_response(status_code, json):
+    response = mock.Mock(status_code=status_code)
+    response.json.return_value = json
+    return response
+
+
+def get_submit_provider(request, dataset_choices=None):
+    provider = get_provider()
+    provider.request = request
+    provider.request.session = {}
+    provider.project = mock.Mock(id=1)
+    if dataset_choices is not None:
+        provider.store_in_session(request, 'dataset_choices', dataset_choices)
+    return provider
+
+
+def test_submit(rf):
+    provider = get_submit_provider(rf.post('/', {'dataset': '1'}), [[0, 'first'], [1, 'second']])
+
+    with mock.patch.object(provider, 'get_post_data', return_value=data) as get_post_data, \
+         mock.patch.object(provider, 'post') as post:
+        provider.submit()
+
+    get_post_data.assert_called_once_with(1)
+    post.assert_called_once_with(provider.request, url, data)
+
+
+def test_submit_unknown_dataset(rf):
+    provider = get_submit_provider(rf.post('/', {'dataset': '2'}), [[0, 'first'], [1, 'second']])
+
+    with mock.patch.object(provider, 'post') as post, \
+         mock.patch('rdmo_zenodo.exports.render') as render:
+        provider.submit()
+
+    post.assert_not_called()
+    form = render.call_args.args[2]['form']
+    assert 'dataset' in form.errors
+
+
+def test_submit_without_session_choices(rf):
+    provider = get_submit_provider(rf.post('/', {'dataset': '0'}))
+    datasets = [mock.Mock(set_index=0, value='first')]
+
+    with mock.patch.object(provider, 'get_set', return_value=datasets) as get_set, \
+         mock.patch.object(provider, 'get_post_data', return_value=data) as get_post_data, \
+         mock.patch.object(provider, 'post'):
+        provider.submit()
+
+    get_set.assert_called_once_with('project/dataset/id')
+    get_post_data.assert_called_once_with(0)
+
+
+def test_post_without_access_token(rf):
+    request = rf.post('/')
+    request.session = {}
+
+    provider = get_provider()
+    with mock.patch.object(provider, 'get_session') as get_session:
+        response = provider.post(request, url, data)
+
+    get_session.assert_not_called()
+    assert response.status_code == 302
+    assert response.url.startswith('https://zenodo.example.com/oauth/authorize?')
+    assert provider.get_from_session(request, 'request') == ('post', url, data, None, None)
+
+
+def test_post_forbidden(rf):
+    request = rf.post('/')
+    request.session = {}
+
+    provider = get_provider()
+    provider.store_in_session(request, 'access_token', 'expired')
+    with mock.patch.object(provider, 'get_session') as get_session:
+        get_session.return_value.post.return_value = get_response(401, {})
+        response = provider.post(request, url, data)
+
+    assert response.status_code == 302
+    assert response.url.startswith('https://zenodo.example.com/oauth/authorize?')
+    assert provider.get_from_session(request, 'access_token') is None
+    assert provider.get_from_session(request, 'request') == ('post', url, data, None, None)
+
+
+@pytest.mark.parametrize('exception,message', [
+    (requests.ReadTimeout, 'The draft may already exist on Zenodo'),
+    (requests.ConnectionError, 'Something went wrong'),
+])
+def test_post_request_exception(rf, exception, message):
+    request = rf.post('/')
+    request.session = {}
+
+    provider = get_provider()
+    provider.store_in_session(request, 'access_token', 'token')
+    with mock.patch.object(provider, 'get_session') as get_session, \
+         mock.patch('rdmo_zenodo.exports.render') as render:
+        get_session.return_value.post.side_effect = exception('error')
+        response = provider.post(request, url, data)
+
+    assert response == render.return_value
+    args, kwargs = render.call_args
+    assert args[1] == 'core/error.html'
+    assert message in str(args[2]['errors'][0])
+    assert provider.get_from_session(request, 'access_token') == 'token'
+
+
+def test_callback_replays_post(rf):
+    session = {}
+
+    # the first export has no access token, so the request is stored and the user is authorized
+    request = rf.post('/')
+    request.session = session
+    get_provider().post(request, url, data)
+
+    state = get_provider().get_from_session(request, 'state')
+
+    # zenodo redirects back to the callback, which gets the token and replays the stored request
+    request = rf.get('/services/oauth/zenodo/callback/', {'state': state, 'code': 'code'})
+    request.session = session
+
+    with mock.patch('rdmo.services.providers.requests.post') as token_post, \
+         mock.patch('rdmo_zenodo.exports.ZenodoExportProvider.get_session') as get_session:
+        token_post.return_value = get_response(200, {'access_token': 'token'})
+        get_session.return_value.post.return_value = get_response(201, {'links': {'self_html': zenodo_url}})
+
+        response = oauth_callback(request, 'zenodo')
+
+    assert response.status_code == 302
+    assert response.url == zenodo_url
+
+    get_session.return_value.post.assert_called_once()
+    args, kwargs = get_session.return_value.post.call_args
+    assert args == (url,)
+    assert kwargs['json'] == data
+    assert kwargs['timeout'] == (5, 30)
+    assert kwargs['headers'] == {'Authorization': 'Bearer token'}
+
+
+@pytest.mark.parametrize('retry_after,sleep', [
+    ('2', 2),
+    ('3600', 10),
+])
+def test_get_session_retries_rate_limited(retry_after, sleep):
+    responses = [
+        HTTPResponse(body=io.BytesIO(b''), status=429, headers={'Retry-After': retry_after},
+                     preload_content=False),
+        HTTPResponse(body=io.BytesIO(b'{}'), status=201, preload_content=False)
+    ]
+
+    with mock.patch.object(HTTPConnectionPool, '_make_request', side_effect=responses) as make_request, \
+         mock.patch('urllib3.util.retry.time.sleep') as time_sleep:
+        response = get_provider().get_session().post(url, json=data)
+
+    assert response.status_code == 201
+    assert make_request.call_count == 2
+    time_sleep.assert_called_once_with(sleep)
@@ -0,0 +1,32 @@
+from pathlib import Path
+
+from rdmo.core.settings import *  # noqa: F403
+
+BASE_DIR = Path(__file__).parent.parent
+
+SECRET_KEY = 'this is a not very secret key'
+
+ROOT_URLCONF = 'config.urls'
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+STATIC_ROOT = BASE_DIR / 'static_root'
+
+MEDIA_ROOT = BASE_DIR / 'media_root'
+
+INSTALLED_APPS = ['rdmo_zenodo', *INSTALLED_APPS]  # noqa: F405
+
+PROJECT_EXPORTS = [
+    ('zenodo', 'Directly to Zenodo', 'rdmo_zenodo.exports.ZenodoExportProvider')
+]
+
+ZENODO_PROVIDER = {
+    'client_id': 'client_id',
+    'client_secret': 'client_secret',
+    'zenodo_url': 'https://zenodo.example.com'
+}